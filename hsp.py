@@ -8,34 +8,412 @@ GitHub: https://github.com/RE-Cat/HSP-Hermesian-probability-
 """
 
 import re
+import enum
+import functools
+import math
 import random
 import cmd
 import sys
 import argparse
-from typing import Any, Dict, List, Optional
+from collections import Counter
+from typing import Any, Dict, List, Optional, Tuple
 from dataclasses import dataclass, field
 
 
-@dataclass
+# 预编译的正则
+_FUNC_DEF_RE = re.compile(r'¢\.(\w+)\(([^)]*)\)')
+_FUNC_CALL_RE = re.compile(r'^(?!¢\.)\w+\([^)]*\)$')
+_CALL_RE = re.compile(r'(\w+)\(([^)]*)\)')
+_RETURN_RE = re.compile(r'return\s*(.+)')
+_ITEM_RE = re.compile(r'\$(\w+)')
+_NAME_RE = re.compile(r'#(\w+)')
+_ASSIGN_RE = re.compile(r'#(\w+)\s*=\s*(.+)')
+_PROB_RE = re.compile(r'([\d.]+)/')
+_TIMES_RE = re.compile(r'×:(\d+)')
+_PITY_RE = re.compile(r'\*(\d+)')
+_MATH_RE = re.compile(r'&A\((.+)\)')
+_OUTPUT_RE = re.compile(r'#(\w+)|\{(inventory|total_spent|pity)\}')
+
+_EXIT = frozenset({'exit', 'quit'})
+_FLOAT_WORDS = frozenset({'inf', 'infinity', 'nan'})
+
+
+class Op(enum.IntEnum):
+    """编译后的指令，格式为 (Op, 源代码行, 操作数…)"""
+    NOP = enum.auto()           # 空操作
+    COMMENT = enum.auto()       # 注释 (文本)
+    OUTPUT = enum.auto()        # 输出 (文本, 模板)
+    POOL = enum.auto()          # 池子定义 (池名, 概率, 物品, 文本)
+    ASSIGN = enum.auto()        # 变量赋值 (变量名, 值, 是否货币, 文本)
+    DRAW = enum.auto()          # 目标抽卡 (目标, 池名, 保底, 文本)
+    MATH = enum.auto()          # 数学运算 (原式, 表达式, 代码, 槽位)
+    CALL = enum.auto()          # 函数调用 (函数名, 实参原文, 实参)
+    RET = enum.auto()           # return (文本)
+    COND = enum.auto()          # 条件
+    DEF = enum.auto()           # 完整函数定义 (函数名, 参数, 函数体)
+    FUNC_START = enum.auto()    # 函数定义开始 (函数名, 参数)
+    FUNC_END = enum.auto()      # 函数定义结束
+    COMMAND = enum.auto()       # 特殊命令 (未知时的文本)
+    ERROR = enum.auto()         # 解析错误 (文本)
+
+
+@dataclass(slots=True)
 class Pool:
     name: str
     total_prob: float
     items: List[str]
+    display_str: str = ''
 
 
-@dataclass
+@dataclass(slots=True)
 class Function:
     name: str
     params: List[str]
-    body: List[str]
+    body: List[Tuple]
+
+
+def _parse_pool_line(line: str):
+    """单遍扫描池子定义，返回 (概率文本, 物品列表, 池名)，缺失的部分为 None"""
+    prob_str = None
+    items: List[str] = []
+    name = None
+    i, n = 0, len(line)
+    while i < n:
+        c = line[i]
+        i += 1
+        if c == '(' and prob_str is None:
+            j = i
+            while j < n and (line[j].isdecimal() or line[j] == '.'):
+                j += 1
+            if j > i and j < n and line[j] == '/':
+                prob_str = line[i:j]
+                i = j
+        elif c == '$' or c == '#':
+            j = i
+            while j < n and (line[j].isalnum() or line[j] == '_'):
+                j += 1
+            if j > i:
+                if c == '$':
+                    items.append(line[i:j])
+                elif name is None:
+                    name = line[i:j]
+                i = j
+    return prob_str, items, name
+
+
+def _simulate_draws(roll, total_prob: float, max_pity: int, pity_counter: int):
+    """模拟连抽直到出货，返回 (第几抽出货, 新保底计数)；保底内未出货时抽数为 0"""
+    # 保底概率上涨前每抽概率不变，首次出货的抽数服从几何分布，采样一次就够
+    flat = min(max_pity, max(0, 70 - pity_counter))
+    if flat and total_prob > 0:
+        if total_prob >= 1:
+            return 1, pity_counter + 1
+        # 概率极小时比值可能是 inf，先比较再转 int
+        misses = math.log(1.0 - roll()) / math.log1p(-total_prob)
+        if misses < flat:
+            draw = int(misses) + 1
+            return draw, pity_counter + draw
+
+    # 进入保底区间后逐抽判定
+    for draw in range(flat + 1, max_pity + 1):
+        pity = pity_counter + draw
+        if roll() < min(1.0, total_prob + (pity - 70) * 0.02):
+            return draw, pity
+    return 0, pity_counter + max_pity
+
+
+def _compile_math(expr: str):
+    """编译数学表达式，#变量 依次换成 _v0、_v1…，返回 (代码, ((槽位, 变量名), …))"""
+    # 槽位前缀不能出现在原式里，否则用户写的名字会撞上槽位
+    prefix = '_v'
+    while prefix in expr:
+        prefix = '_' + prefix
+    slots: Dict[str, str] = {}
+
+    def slot(match):
+        var = sys.intern(match.group(1))
+        if var not in slots:
+            slots[var] = f'{prefix}{len(slots)}'
+        return slots[var]
+
+    code = compile(_NAME_RE.sub(slot, expr), '<math>', 'eval')
+    return code, tuple((name, var) for var, name in slots.items())
+
+
+def _compile_body(lines: List[str], params: List[str]) -> List[Tuple]:
+    """编译函数体：不含参数的行直接编成指令，含参数的行拆成模板
+    (文本, 参数序号, 文本, 参数序号, …, 文本)，调用时再代入编译"""
+    slots: Dict[str, int] = {}
+    for i, param in enumerate(params):
+        if param:
+            slots.setdefault(param, i)
+    param_re = None
+    if slots:
+        param_re = re.compile(r'#(' + '|'.join(map(re.escape, slots)) + r')\b')
+
+    body = []
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        parts = param_re.split(line) if param_re is not None else [line]
+        if len(parts) == 1:
+            body.append((_compile_line(line), None))
+            continue
+        parts[1::2] = [slots[p] for p in parts[1::2]]
+        body.append((None, tuple(parts)))
+    return body
+
+
+def _parse_func_header(line: str):
+    """解析 ¢.函数名(参数)，返回 (函数名, 参数)"""
+    match = _FUNC_DEF_RE.match(line)
+    if not match:
+        raise ValueError("函数定义: ¢.函数名(参数)")
+
+    params_str = match.group(2).strip()
+    params = tuple(p.strip() for p in params_str.split(',')) if params_str else ()
+    return sys.intern(match.group(1)), params
+
+
+def _compile_cent(line: str) -> Tuple:
+    # 输出
+    if line.startswith('¢,'):
+        return _compile_output(line)
+
+    # 注释
+    if not line.startswith('¢.'):
+        comment = line[1:].strip()
+        if comment:
+            return (Op.COMMENT, line, f"[注] {comment}")
+        return (Op.NOP, line)
+
+    # 函数定义开始
+    if '¢.End' not in line:
+        # 单行函数或开始多行函数
+        if line.endswith(')'):
+            return (Op.FUNC_START, line) + _parse_func_header(line)
+        return (Op.NOP, line)
+
+    # 函数定义结束
+    if line == '¢.End':
+        return (Op.FUNC_END, line)
+
+    return _compile_command(line)
+
+
+def _compile_output(line: str) -> Tuple:
+    content = line[2:]
+
+    # 纯文本不需要替换
+    if '#' not in content and '{' not in content:
+        return (Op.OUTPUT, line, f"[出] {content}", None)
+
+    # 拆成 (文本, (变量名, 占位符), 文本, …)
+    parts = _OUTPUT_RE.split(content)
+    if len(parts) == 1:
+        return (Op.OUTPUT, line, f"[出] {content}", None)
+    template = [parts[0]]
+    for i in range(1, len(parts), 3):
+        var_name = parts[i]
+        template.append((sys.intern(var_name) if var_name else None, parts[i + 1]))
+        template.append(parts[i + 2])
+    return (Op.OUTPUT, line, None, tuple(template))
+
+
+def _compile_pool(line: str) -> Tuple:
+    prob_str, items, pool_name = _parse_pool_line(line)
+    if prob_str is None:
+        raise ValueError("池子: (0.6/:$雷电)#UP")
+
+    total_prob = float(prob_str) / 100
+
+    if not items:
+        raise ValueError("池子需要物品")
+
+    if pool_name is None:
+        raise ValueError("池子需要命名")
+
+    pool_name = sys.intern(pool_name)
+    display_str = f"[池] #{pool_name} | {total_prob*100}% | " + ','.join(['$' + i for i in items])
+    return (Op.POOL, line, pool_name, total_prob, tuple(items), display_str)
+
+
+def _compile_hash(line: str) -> Tuple:
+    # 变量赋值
+    if '=' in line and not line.startswith('#¢'):
+        return _compile_assign(line)
+    return _compile_command(line)
+
+
+def _compile_assign(line: str) -> Tuple:
+    match = _ASSIGN_RE.match(line)
+    if not match:
+        raise ValueError("赋值: #变量 = 值")
+
+    name, value_str = match.groups()
+    name = sys.intern(name)
+    value_str = value_str.strip()
+    text = f"[变] #{name} = {value_str}"
+
+    if value_str.startswith('¥'):
+        return (Op.ASSIGN, line, name, float(value_str[1:]), True, text)
+    elif value_str.endswith('/'):
+        prob_match = _PROB_RE.search(value_str)
+        if not prob_match:
+            return (Op.ASSIGN, line, None, None, False, text)
+        return (Op.ASSIGN, line, name, float(prob_match.group(1)) / 100, False, text)
+    else:
+        # 先看是不是普通数字，明显不是数字的字符串值就不用走异常
+        digits = value_str[1:] if value_str[:1] in '+-' else value_str
+        if digits.replace('.', '', 1).isdecimal():
+            value = float(value_str)
+        elif value_str and (value_str[0] in '+-.' or value_str[0].isdecimal()
+                            or value_str.lower() in _FLOAT_WORDS):
+            # 1e5、1_000、-inf 之类也是数字
+            try:
+                value = float(value_str)
+            except ValueError:
+                value = value_str
+        else:
+            value = value_str
+        return (Op.ASSIGN, line, name, value, False, text)
+
+
+def _compile_target(line: str) -> Tuple:
+    item_match = _ITEM_RE.search(line)
+    if not item_match:
+        raise ValueError("目标: <$雷电,#UP,*90>")
+    target_item = sys.intern(item_match.group(1))
+
+    # 池子是否存在要到运行时才知道
+    pool_match = _NAME_RE.search(line)
+    pool_name = sys.intern(pool_match.group(1)) if pool_match else None
+
+    times_match = _TIMES_RE.search(line)
+    draw_times = int(times_match.group(1)) if times_match else 1
+
+    pity_match = _PITY_RE.search(line)
+    max_pity = int(pity_match.group(1)) if pity_match else 90
+
+    text = f"[抽] ${target_item} | #{pool_name} | {draw_times}连 | 保底{max_pity}"
+    return (Op.DRAW, line, target_item, pool_name, max_pity, text)
+
+
+def _compile_amp(line: str) -> Tuple:
+    # 数学运算
+    if not line.startswith('&A('):
+        return _compile_command(line)
+
+    match = _MATH_RE.search(line)
+    if not match:
+        return (Op.NOP, line)
+
+    expr = match.group(1).replace('×', '*').replace('÷', '/')
+    # 编译失败（语法错误、嵌套太深、太长）都留到运行时报 [算] 错误
+    try:
+        code, slots = _compile_math(expr)
+    except (SyntaxError, ValueError, RecursionError, MemoryError):
+        code, slots = None, ()
+    return (Op.MATH, line, match.group(1), expr, code, slots)
+
+
+def _compile_word(line: str) -> Tuple:
+    # 函数调用
+    if _FUNC_CALL_RE.match(line):
+        match = _CALL_RE.match(line)
+        args_str = match.group(2).strip()
+        args = tuple(a.strip() for a in args_str.split(',')) if args_str else ()
+        return (Op.CALL, line, sys.intern(match.group(1)), args_str, args)
+
+    # return 语句
+    if line.startswith('return'):
+        match = _RETURN_RE.match(line)
+        if match:
+            return (Op.RET, line, f"[返] {match.group(1).strip()}")
+        return (Op.NOP, line)
+
+    return _compile_command(line)
+
+
+def _compile_command(line: str) -> Tuple:
+    # 特殊命令在运行时查表，查不到就是未知
+    return (Op.COMMAND, line, f"[?] 未知: {line[:40]}")
+
+
+_LINE_COMPILERS = {
+    '¢': _compile_cent,
+    '(': _compile_pool,                     # 池子定义
+    '#': _compile_hash,
+    '<': _compile_target,                   # 目标抽卡
+    '&': _compile_amp,
+    '?': lambda line: (Op.COND, line),      # 条件
+}
+
+
+@functools.lru_cache(maxsize=1024)
+def _compile_line(line: str) -> Tuple:
+    """把一行（已去掉首尾空白）编译成指令，编译出错编成 ERROR 指令"""
+    # 按首字符分派
+    compiler = _LINE_COMPILERS.get(line[0], _compile_word)
+    try:
+        return compiler(line)
+    except Exception as e:
+        return (Op.ERROR, line, f"[!] {str(e)}")
+
+
+def compile_script(code: str) -> List[Tuple]:
+    """把整段脚本编译成指令列表，多行函数定义编成一条 DEF 指令"""
+    ops = []
+    # 一次性去掉首尾空白，后面直接用
+    lines = iter([line.strip() for line in code.split('\n')])
+    for line in lines:
+        if not line:
+            continue
+
+        if not line.startswith('¢.'):
+            ops.append(_compile_line(line))
+            continue
+
+        # 先解析函数头，写错了只报这一行，后面的行照常编译
+        try:
+            name, params = _parse_func_header(line)
+        except Exception as e:
+            ops.append((Op.ERROR, line, f"[!] {str(e)}"))
+            continue
+
+        # 处理函数定义（多行），收集函数体
+        body_lines = []
+        closed = False
+        for func_line in lines:
+            if func_line == '¢.End':
+                closed = True
+                break
+            body_lines.append(func_line)
+
+        if closed:
+            ops.append((Op.DEF, line, name, params, _compile_body(body_lines, params)))
+        else:
+            # 没写 ¢.End：开始定义，剩下的行留给之后的输入继续收集
+            ops.append((Op.FUNC_START, line, name, params))
+            ops.extend(_compile_line(func_line) for func_line in body_lines if func_line)
+    return ops
 
 
 class HPSInterpreter:
+    __slots__ = (
+        'variables', 'pools', 'currency', 'inventory', 'pity_counter', 'total_spent',
+        'functions', 'output_lines', 'in_function', 'current_function_lines',
+        'current_function_name', 'current_function_params', 'rng',
+    )
+
+    _SEP = "─" * 40
+
     def __init__(self):
         self.variables: Dict[str, Any] = {}
         self.pools: Dict[str, Pool] = {}
         self.currency: Dict[str, float] = {}
-        self.inventory: List[str] = []
+        self.inventory: Counter = Counter()
         self.pity_counter: int = 0
         self.total_spent: float = 0
         self.functions: Dict[str, Function] = {}
@@ -44,74 +422,55 @@ class HPSInterpreter:
         self.current_function_lines: List[str] = []
         self.current_function_name: str = ""
         self.current_function_params: List[str] = []
+        self.rng = random.Random()
 
     def reset(self):
         self.__init__()
 
-    def execute(self, line: str, show_prompt: bool = False) -> List[str]:
-        self.output_lines = []
+    def execute(self, line: str) -> List[str]:
         line = line.strip()
         if not line:
+            self.output_lines = []
             return []
 
-        if show_prompt and not self.in_function:
-            print(f"hps> {line}")
+        return self._execute_op(_compile_line(line))
 
+    def run_script(self, code: str, verbose: bool = True) -> None:
+        for op in compile_script(code):
+            outputs = self._execute_op(op)
+            if verbose and outputs:
+                sys.stdout.write('\n'.join(outputs) + '\n')
+
+    def _execute_op(self, op: Tuple) -> List[str]:
+        self.output_lines = []
         try:
-            self._execute_line(line)
+            self._run_op(op)
         except Exception as e:
             self.output_lines.append(f"[!] {str(e)}")
 
         return self.output_lines
 
-    def run_script(self, code: str, verbose: bool = True) -> None:
-        lines = code.strip().split('\n')
-        i = 0
-        while i < len(lines):
-            line = lines[i].strip()
-            if not line:
-                i += 1
-                continue
-
-            # 处理函数定义（多行）
-            if line.startswith('¢.') and not self.in_function:
-                # 收集函数体
-                self._start_function_def(line)
-                i += 1
-                while i < len(lines):
-                    func_line = lines[i].strip()
-                    if func_line == '¢.End':
-                        self._end_function_def()
-                        break
-                    self.current_function_lines.append(func_line)
-                    i += 1
-                i += 1
-                continue
-
-            outputs = self.execute(line, show_prompt=False)
-            if verbose:
-                for out in outputs:
-                    print(out)
-            i += 1
-
-    def _start_function_def(self, line: str):
-        """开始函数定义"""
-        match = re.match(r'¢\.(\w+)\(([^)]*)\)', line)
-        if not match:
-            raise ValueError("函数定义: ¢.函数名(参数)")
+    def _run_op(self, op: Tuple):
+        # 如果在函数定义中，只收集不执行
+        if self.in_function and not op[1].startswith('¢.'):
+            self.current_function_lines.append(op[1])
+            return
+
+        self._OPCODE_HANDLERS[op[0]](self, op)
 
-        self.current_function_name = match.group(1)
-        params_str = match.group(2).strip()
-        self.current_function_params = [p.strip() for p in params_str.split(',')] if params_str else []
+    def _start_function_def(self, op: Tuple):
+        """开始函数定义"""
+        self.current_function_name = op[2]
+        self.current_function_params = list(op[3])
         self.current_function_lines = []
         self.in_function = True
 
-    def _end_function_def(self):
+    def _end_function_def(self, op: Tuple):
         """结束函数定义"""
         func = Function(
             self.current_function_name,
             self.current_function_params,
-            self.current_function_lines
+            _compile_body(self.current_function_lines, self.current_function_params)
         )
         self.functions[self.current_function_name] = func
         self.output_lines.append(f"[函] ¢.{self.current_function_name} 定义完成")
@@ -120,280 +479,217 @@ class HPSInterpreter:
         self.current_function_params = []
         self.current_function_lines = []
 
-    def _execute_line(self, line: str):
-        # 如果在函数定义中，只收集不执行
-        if self.in_function and not line.startswith('¢.'):
-            self.current_function_lines.append(line)
-            return
-
-        # 输出
-        if line.startswith('¢,'):
-            self._handle_output(line)
-            return
-
-        # 注释
-        if line.startswith('¢') and not line.startswith('¢.'):
-            comment = line[1:].strip()
-            if comment:
-                self.output_lines.append(f"[注] {comment}")
-            return
-
-        # 函数定义开始
-        if line.startswith('¢.') and '¢.End' not in line:
-            # 单行函数或开始多行函数
-            if line.endswith(')'):
-                self._start_function_def(line)
-            return
-
-        # 函数定义结束
-        if line == '¢.End':
-            self._end_function_def()
-            return
-
-        # 函数调用
-        if re.match(r'^(?!¢\.)\w+\([^)]*\)$', line) and '(' in line:
-            self._call_function(line)
-            return
-
-        # return 语句
-        if line.startswith('return'):
-            self._handle_return(line)
-            return
-
-        # 池子定义
-        if line.startswith('('):
-            self._define_pool(line)
-            return
-
-        # 变量赋值
-        if line.startswith('#') and '=' in line and not line.startswith('#¢'):
-            self._assign_variable(line)
-            return
-
-        # 目标抽卡
-        if line.startswith('<'):
-            self._execute_target(line)
-            return
-
-        # 数学运算
-        if line.startswith('&A('):
-            self._handle_math(line)
-            return
-
-
-        # 条件
-        if line.startswith('?'):
-            self._handle_condition(line)
-            return
+    def _define_function(self, op: Tuple):
+        """脚本里完整的函数定义，函数体已经编译好"""
+        _, _, name, params, body = op
+        self.functions[name] = Function(name, list(params), body)
 
+    def _execute_command(self, op: Tuple):
         # 特殊命令
-        if line == '/state':
-            self.output_lines.append(self.get_state())
+        command = self._COMMANDS.get(op[1])
+        if command is not None:
+            command(self)
             return
-        if line == '/reset':
-            self.reset()
-            self.output_lines.append("[✓] 已重置")
-            return
-
-        if line in ['exit', 'quit']:
-            self.output_lines.append("[bye]")
-            return
-
-        self.output_lines.append(f"[?] 未知: {line[:40]}")
-
-    def _define_pool(self, line: str):
-        prob_match = re.search(r'\(([\d.]+)/', line)
-        if not prob_match:
-            raise ValueError("池子: (0.6/:$雷电)#UP")
-
-        total_prob = float(prob_match.group(1)) / 100
-        items = re.findall(r'\$(\w+)', line)
-
-        if not items:
-            raise ValueError("池子需要物品")
 
-        name_match = re.search(r'#(\w+)', line)
-        if not name_match:
-            raise ValueError("池子需要命名")
-
-        pool_name = name_match.group(1)
-        self.pools[pool_name] = Pool(pool_name, total_prob, items)
-
-        items_str = ','.join(f'${i}' for i in items)
-        self.output_lines.append(f"[池] #{pool_name} | {total_prob*100}% | {items_str}")
-
-    def _assign_variable(self, line: str):
-        match = re.match(r'#(\w+)\s*=\s*(.+)', line)
-        if not match:
-            raise ValueError("赋值: #变量 = 值")
-
-        name, value_str = match.groups()
-        value_str = value_str.strip()
-
-        if value_str.startswith('¥'):
-            self.currency[name] = float(value_str[1:])
-        elif value_str.endswith('/'):
-            prob_match = re.search(r'([\d.]+)/', value_str)
-            if prob_match:
-                self.variables[name] = float(prob_match.group(1)) / 100
-        else:
-            try:
-                self.variables[name] = float(value_str)
-            except:
-                self.variables[name] = value_str
-
-        self.output_lines.append(f"[变] #{name} = {value_str}")
-
-    def _execute_target(self, line: str):
-        item_match = re.search(r'\$(\w+)', line)
-        if not item_match:
-            raise ValueError("目标: <$雷电,#UP,*90>")
-        target_item = item_match.group(1)
-
-        pool_match = re.search(r'#(\w+)', line)
-        if not pool_match or pool_match.group(1) not in self.pools:
+        self.output_lines.append(op[2])
+
+    def _command_state(self):
+        self.output_lines.append(self.get_state())
+
+    def _command_reset(self):
+        self.reset()
+        self.output_lines.append("[✓] 已重置")
+
+    def _command_bye(self):
+        self.output_lines.append("[bye]")
+
+    _COMMANDS = {
+        '/state': _command_state,
+        '/reset': _command_reset,
+        'exit': _command_bye,
+        'quit': _command_bye,
+    }
+
+    def _emit_text(self, op: Tuple):
+        self.output_lines.append(op[2])
+
+    def _define_pool(self, op: Tuple):
+        # 指令会被缓存共用，每次定义都新建 Pool
+        _, _, pool_name, total_prob, items, display_str = op
+        self.pools[pool_name] = Pool(pool_name, total_prob, list(items), display_str)
+        self.output_lines.append(display_str)
+
+    def _assign_variable(self, op: Tuple):
+        _, _, name, value, is_currency, text = op
+        if name is not None:
+            if is_currency:
+                self.currency[name] = value
+            else:
+                self.variables[name] = value
+
+        self.output_lines.append(text)
+
+    def _execute_target(self, op: Tuple):
+        _, _, target_item, pool_name, max_pity, text = op
+        append = self.output_lines.append
+        inventory = self.inventory
+        if pool_name not in self.pools:
             raise ValueError(f"池子未定义")
-        pool_name = pool_match.group(1)
         pool = self.pools[pool_name]
 
-        times_match = re.search(r'×:(\d+)', line)
-        draw_times = int(times_match.group(1)) if times_match else 1
-
-        pity_match = re.search(r'\*(\d+)', line)
-        max_pity = int(pity_match.group(1)) if pity_match else 90
+        append(text)
 
-        self.output_lines.append(f"[抽] ${target_item} | #{pool_name} | {draw_times}连 | 保底{max_pity}")
-
-        for draw in range(1, max_pity + 1):
-            self.pity_counter += 1
-            current_prob = pool.total_prob
-
-            if self.pity_counter > 70:
-                current_prob = min(1.0, current_prob + (self.pity_counter - 70) * 0.02)
+        items = pool.items
+        draw, self.pity_counter = _simulate_draws(
+            self.rng.random, pool.total_prob, max_pity, self.pity_counter
+        )
 
-            if random.random() < current_prob:
-                drawn = random.choice(pool.items)
-                self.inventory.append(drawn)
+        if draw:
+            drawn = self.rng.choice(items)
+            inventory[drawn] += 1
 
-                if draw <= 3 or drawn == target_item or draw >= max_pity - 2:
-                    pity_tag = f"[{self.pity_counter}]" if self.pity_counter > 70 else ""
-                    self.output_lines.append(f"     第{draw}抽: ${drawn} {pity_tag}")
+            if draw <= 3 or drawn == target_item or draw >= max_pity - 2:
+                pity_tag = f"[{self.pity_counter}]" if self.pity_counter > 70 else ""
+                append(f"     第{draw}抽: ${drawn} {pity_tag}")
 
-                if drawn == target_item:
-                    cost = draw * 160
-                    self.total_spent += cost
-                    self.output_lines.append(f"[✓] 出货! ${target_item} | {draw}抽 ¥{cost}")
-                    self.pity_counter = 0
-                    return
-                break
+            if drawn == target_item:
+                cost = draw * 160
+                self.total_spent += cost
+                append(f"[✓] 出货! ${target_item} | {draw}抽 ¥{cost}")
+                self.pity_counter = 0
         else:
-            self.inventory.append(target_item)
+            inventory[target_item] += 1
             cost = max_pity * 160
             self.total_spent += cost
-            self.output_lines.append(f"[!] 保底 | ${target_item} | {max_pity}抽 ¥{cost}")
+            append(f"[!] 保底 | ${target_item} | {max_pity}抽 ¥{cost}")
             self.pity_counter = 0
 
-    def _handle_output(self, line: str):
-        content = line[2:]
+    def _handle_output(self, op: Tuple):
+        _, _, text, template = op
+        if template is None:
+            self.output_lines.append(text)
+            return
 
-        def replace_var(match):
-            var_name = match.group(1)
-            if var_name in self.variables:
-                val = self.variables[var_name]
+        variables, currency = self.variables, self.currency
+        pieces = list(template)
+        for i in range(1, len(pieces), 2):
+            var_name, key = pieces[i]
+            if key == 'inventory':
+                pieces[i] = str(dict(self.inventory))
+            elif key == 'total_spent':
+                pieces[i] = f'¥{self.total_spent}'
+            elif key == 'pity':
+                pieces[i] = str(self.pity_counter)
+            elif var_name in variables:
+                val = variables[var_name]
                 if isinstance(val, float) and val < 1:
-                    return f"{val*100}%"
-                return str(val)
-            elif var_name in self.currency:
-                return f"¥{self.currency[var_name]}"
-            return f"[未定义:#{var_name}]"
-
-        content = re.sub(r'#(\w+)', replace_var, content)
-        content = content.replace('{inventory}', str(self.inventory))
-        content = content.replace('{total_spent}', f'¥{self.total_spent}')
-        content = content.replace('{pity}', str(self.pity_counter))
-
-        self.output_lines.append(f"[出] {content}")
-
-    def _handle_math(self, line: str):
-        match = re.search(r'&A\((.+)\)', line)
-        if match:
-            expr = match.group(1)
-            for var, val in self.variables.items():
-                expr = expr.replace(f'#{var}', str(val))
-            for var, val in self.currency.items():
-                expr = expr.replace(f'#{var}', str(val))
-
-            expr = expr.replace('×', '*').replace('÷', '/')
-
-            try:
-                result = eval(expr, {"__builtins__": {}}, {})
-                self.output_lines.append(f"[算] {match.group(1)} = {result:.2f}")
-            except:
-                self.output_lines.append(f"[算] 错误: {expr}")
-
-
-    def _call_function(self, line: str):
-        """调用函数"""
-        match = re.match(r'(\w+)\(([^)]*)\)', line)
-        if not match:
+                    pieces[i] = f"{val*100}%"
+                else:
+                    pieces[i] = str(val)
+            elif var_name in currency:
+                pieces[i] = f"¥{currency[var_name]}"
+            else:
+                pieces[i] = f"[未定义:#{var_name}]"
+
+        self.output_lines.append("[出] " + ''.join(pieces))
+
+    def _handle_math(self, op: Tuple):
+        _, _, label, expr, code, slots = op
+        if code is None:
+            self.output_lines.append(f"[算] 错误: {expr}")
             return
 
-        func_name = match.group(1)
-        args_str = match.group(2).strip()
-        args = [a.strip() for a in args_str.split(',')] if args_str else []
+        try:
+            # 只取表达式里用到的变量
+            variables, currency = self.variables, self.currency
+            scope = {}
+            for name, var in slots:
+                if var in variables:
+                    scope[name] = variables[var]
+                elif var in currency:
+                    scope[name] = currency[var]
+            result = eval(code, {"__builtins__": {}}, scope)
+            self.output_lines.append(f"[算] {label} = {result:.2f}")
+        except (ArithmeticError, AttributeError, LookupError, NameError, TypeError, ValueError,
+                MemoryError):
+            self.output_lines.append(f"[算] 错误: {expr}")
+
+    def _call_function(self, op: Tuple):
+        """调用函数"""
+        _, _, func_name, args_str, args = op
 
         if func_name not in self.functions:
             self.output_lines.append(f"[!] 函数未定义: {func_name}")
             return
 
         func = self.functions[func_name]
-        self.output_lines.append(f"[调] ¢.{func_name}({args_str})")
+        output_lines = self.output_lines
+        append = output_lines.append
+        append(f"[调] ¢.{func_name}({args_str})")
+
+        # 缺少的实参保留原样 #参数
+        values = [*args, *(f'#{p}' for p in func.params[len(args):])]
 
         # 执行函数体
-        for body_line in func.body:
-            body_line = body_line.strip()
-            if not body_line:
-                continue
-
-            # 替换参数
-            for i, param in enumerate(func.params):
-                if i < len(args):
-                    body_line = body_line.replace(f'#{param}', args[i])
-
-            # 执行
-            outputs = self.execute(body_line, show_prompt=False)
-            for out in outputs:
+        for body_op, parts in func.body:
+            # 替换参数后再编译
+            if body_op is None:
+                pieces = list(parts)
+                pieces[1::2] = [values[i] for i in parts[1::2]]
+                body_line = ''.join(pieces).strip()
+                if not body_line:
+                    continue
+                body_op = _compile_line(body_line)
+
+            # 执行，函数体的输出先收进单独的列表
+            self.output_lines = []
+            try:
+                self._run_op(body_op)
+            except Exception as e:
+                self.output_lines.append(f"[!] {str(e)}")
+            for out in self.output_lines:
                 if not out.startswith('[函]'):
-                    self.output_lines.append(f"  {out}")
-
-    def _handle_return(self, line: str):
-        """处理 return"""
-        match = re.match(r'return\s*(.+)', line)
-        if match:
-            value = match.group(1).strip()
-            self.output_lines.append(f"[返] {value}")
+                    append(f"  {out}")
+
+        self.output_lines = output_lines
+
+    _OPCODE_HANDLERS = {
+        Op.NOP: lambda self, op: None,
+        Op.COMMENT: _emit_text,
+        Op.OUTPUT: _handle_output,
+        Op.POOL: _define_pool,
+        Op.ASSIGN: _assign_variable,
+        Op.DRAW: _execute_target,
+        Op.MATH: _handle_math,
+        Op.CALL: _call_function,
+        Op.RET: _emit_text,
+        Op.COND: lambda self, op: self._handle_condition(op[1]),
+        Op.DEF: _define_function,
+        Op.FUNC_START: _start_function_def,
+        Op.FUNC_END: _end_function_def,
+        Op.COMMAND: _execute_command,
+        Op.ERROR: _emit_text,
+    }
 
     def get_state(self) -> str:
-        lines = ["─" * 40]
-        lines.append("📊 状态")
+        buf = [self._SEP, "📊 状态"]
+        add = buf.append
         if self.pools:
-            lines.append(f"  池: {list(self.pools.keys())}")
+            add(f"  池: {list(self.pools.keys())}")
         if self.functions:
-            lines.append(f"  函: {list(self.functions.keys())}")
+            add(f"  函: {list(self.functions.keys())}")
         if self.variables:
-            vars_display = {}
-            for k, v in self.variables.items():
-                if isinstance(v, float) and v < 1:
-                    vars_display[k] = f"{v*100}%"
-                else:
-                    vars_display[k] = v
-            lines.append(f"  变: {vars_display}")
+            vars_display = ', '.join(
+                f"{k!r}: {f'{v*100}%'!r}" if isinstance(v, float) and v < 1 else f"{k!r}: {v!r}"
+                for k, v in self.variables.items()
+            )
+            add(f"  变: {{{vars_display}}}")
         if self.currency:
-            lines.append(f"  钱: {self.currency}")
-        lines.append(f"  库: {self.inventory}")
-        lines.append(f"  保: {self.pity_counter} | 花: ¥{self.total_spent}")
-        lines.append("─" * 40)
-        return "\n".join(lines)
+            add(f"  钱: {self.currency}")
+        add(f"  库: {dict(self.inventory)}")
+        add(f"  保: {self.pity_counter} | 花: ¥{self.total_spent}")
+        add(self._SEP)
+        return "\n".join(buf)
 
 
 class HPSREPL(cmd.Cmd):
@@ -410,11 +706,14 @@ class HPSREPL(cmd.Cmd):
         self.interpreter = HPSInterpreter()
 
     def default(self, line: str):
-        if line.strip() in ['exit', 'quit']:
+        if line.strip() in _EXIT:
             print("再见!")
             return True
 
-        outputs = self.interpreter.execute(line, show_prompt=True)
+        if line.strip() and not self.interpreter.in_function:
+            print(f"hps> {line.strip()}")
+
+        outputs = self.interpreter.execute(line)
         for out in outputs:
             print(out)
 